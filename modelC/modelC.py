@@ -60,28 +60,281 @@ fnameFEB   = '/tmp/hip_n10rb.feb'
 fnameTEMP  = '/tmp/temp.feb'
 ### Set material parameter:
 K          = 1350
+### (Optional) Parse only elements adjacent to a named FEB surface  (None = all elements):
+surfaceROI = None
 #---------------------------------------------------------------#
 
 
 
-def parse_logfile(fname):
+def element_index(fnameFEB, root=None):
+	'''
+	Load (or build) the element index of an FEB file.
+	
+	The index is cached in a NPZ file alongside the FEB file (if the folder is
+	writable) and is only rebuilt if the FEB file has been modified since the
+	cache was written.
+	
+	Arguments:
+	fnameFEB -- FEB file
+	root -- (optional) root of the already-parsed FEB file (avoids parsing it again when the cache must be rebuilt)
+	
+	Returns:
+	index -- a dictionary containing:
+		"centroids" -- an (nElement x 3) array containing element centroids (row i = element ID i+1)
+		"elementIDs" -- an (nElement,) array containing element IDs  (1..nElement)
+		"nodeIDs" -- a sorted (nNode,) array of node IDs
+		"indptr", "indices" -- node-to-element adjacency:  the elements containing node nodeIDs[k] are indices[indptr[k]:indptr[k+1]]
+	'''
+	fnameNPZ      = os.path.splitext(fnameFEB)[0] + '_index.npz'
+	if os.path.exists(fnameNPZ) and ( os.path.getmtime(fnameNPZ) >= os.path.getmtime(fnameFEB) ):
+		Z         = np.load(fnameNPZ)
+		index     = dict( (key, Z[key])   for key in Z.files )
+		Z.close()
+		return index
+	if root is None:
+		tree      = ElementTree()
+		tree.parse(fnameFEB)
+		root      = tree.getroot()
+	nodes,elements = parse_geometry(root)
+	### element indices are used as (element ID - 1) throughout, so IDs must run 1..N in Geometry order:
+	if [eid   for eid,conn in elements] != list(range(1, len(elements)+1)):
+		raise( ValueError('Element IDs must run from 1 to %d in Geometry order in:\n   %s' %(len(elements),fnameFEB))  )
+	### node-to-element adjacency (compressed sparse row format):
+	n             = np.array([i   for eid,conn in elements for i in conn], dtype=int)
+	e             = np.repeat(np.arange(len(elements)), [len(conn) for eid,conn in elements])
+	ind           = np.argsort(n, kind='mergesort')
+	nodeIDs,indptr = np.unique(n[ind], return_index=True)
+	index         = dict(
+		centroids  = np.array([np.mean([nodes[i] for i in conn], axis=0)   for eid,conn in elements]),
+		elementIDs = np.array([eid   for eid,conn in elements], dtype=int),
+		nodeIDs    = nodeIDs,
+		indptr     = np.append(indptr, n.size),
+		indices    = e[ind],
+	)
+	try:
+		np.savez(fnameNPZ, **index)
+	except (IOError, OSError):   #e.g. read-only folder:  use the index without caching it
+		pass
+	return index
+
+
+def iter_logfile(fnameLOG, elements=None, columns=None, effective=None):
+	'''
+	Iterate over all data records in an FEBio log file.
+	
+	Records are parsed and yielded one at a time, so only a single record
+	is held in memory regardless of the number of time steps.
+	
+	Arguments:
+	fnameLOG -- full path to the log file
+	elements -- (optional) zero-based element indices (element ID - 1) to retain
+	columns -- (optional) column indices to retain  (0-5 = strain tensor, 6-11 = stress tensor)
+	effective -- (optional) "strain" or "stress" to convert each record to an effective strain or von Mises stress field
+	
+	Yields:
+	time -- simulation time (float)
+	step -- time step number (int)
+	A -- an (nElement x nColumn) array with rows sorted by element ID, or an (nElement,) array if "effective" is specified
+	'''
+	if effective is not None:
+		if columns is not None:
+			raise( ValueError('Only one of "columns" and "effective" may be specified.')  )
+		if effective not in ('strain', 'stress'):
+			raise( ValueError('"effective" must be "strain" or "stress", not %s' %str(effective))  )
+		columns = slice(0,6) if effective=='strain' else slice(6,12)
+	if elements is not None:
+		elements = set( np.unique(elements).tolist() )
+	msg    = 'Truncated data record (%s) in log file:\n   %s\n\nThe FEBio simulation may have terminated with an error.\n'
+	nRows0 = None   #number of rows in the previous record
+	with open(fnameLOG, 'r') as fid:
+		lines = iter(fid)
+		s     = next(lines, '')
+		while s:
+			if not s.startswith('Data Record'):
+				s = next(lines, '')
+				continue
+			record = s.strip()
+			### header:  separator, step, time, column labels
+			header = [next(lines, '')   for k in range(4)]
+			if not ( header[1].startswith('Step') and header[2].startswith('Time') and header[3].startswith('Data') ):
+				raise( IOError(msg %(record,fnameLOG))  )
+			step   = int( header[1].split('=')[1] )
+			time   = float( header[2].split('=')[1] )
+			nCols  = len( header[3].split('=')[1].split(';') )
+			### element rows (selected by element ID):
+			A,ids  = [],[]
+			nRows  = 0
+			for s in lines:
+				if not s[:1].isdigit():              #end of record
+					break
+				nRows += 1
+				last   = s
+				i      = int( s.split(None, 1)[0] ) - 1  #zero-based element index
+				if (elements is None) or (i in elements):
+					x      = s.split()
+					if len(x) != nCols+1:
+						raise( IOError(msg %(record,fnameLOG))  )
+					A.append( x[1:] )
+					ids.append( i )
+			else:                                    #log file ended inside the record
+				raise( IOError(msg %(record,fnameLOG))  )
+			if (nRows>0) and (len(last.split()) != nCols+1):  #partially written final row
+				raise( IOError(msg %(record,fnameLOG))  )
+			if (nRows0 is not None) and (nRows != nRows0):
+				raise( IOError(msg %(record,fnameLOG))  )
+			nRows0 = nRows
+			if (elements is not None) and (len(ids) < len(elements)):
+				missing = sorted( elements - set(ids) )
+				raise( ValueError('Element indices not found in data record (Step = %d) of log file:\n   %s\n\nMissing indices: %s\n' %(step,fnameLOG,str(missing)))  )
+			A      = np.asarray(A, dtype=float).reshape(-1, nCols)[ np.argsort(ids, kind='mergesort') ]
+			if columns is not None:
+				A = A[:,columns]
+			if effective is not None:
+				A = tensor2effective(A)
+			yield time, step, A
+
+
+def parse_geometry(root):
+	'''
+	Reads the nodes and element connectivity from the Geometry section of an FEB file.
+	
+	Arguments:
+	root -- root of the parsed FEB file
+	
+	Returns:
+	nodes -- a dictionary of node coordinates:  {nodeID: (x,y,z)}
+	elements -- a list of (elementID, nodeIDs) tuples in Geometry order
+	'''
+	nodes     = dict( (int(node.get('id')), [float(x) for x in node.text.split(',')])   for node in root.findall('Geometry/Nodes/node') )
+	elements  = [(int(elem.get('id')), [int(i) for i in elem.text.split(',')])   for elem in root.findall('Geometry/Elements/elem')]
+	return nodes, elements
+
+
+def parse_logfile(fname, elements=None):
 	'''
 	Reads the strain and stress tensor fields from the final data record in an FEBio log file.
 	
 	Arguments:
 	fname -- full path to the log file
+	elements -- (optional) zero-based element indices to retain
 	
 	Returns:
 	A -- an (nElement x 12) array containing the strain and stress tensor fields
 	'''
-	with open(fnameLOG, 'r') as fid:
-		lines = fid.readlines()
-	for i,s in enumerate(lines):
-		if s.startswith('Data Record'):
-			break
-	i += 5
-	A  = [s.strip().split(' ')[1:]   for s in lines[i:i+149300]]
-	return np.asarray(A, dtype=float)
+	A = None
+	for time,step,A in iter_logfile(fname, elements):
+		pass
+	if A is None:
+		raise( IOError('No data records found in the log file:\n   %s\n\nThe FEBio simulation may have terminated with an error.\n' %fname)  )
+	return A
+
+
+def roi_box(tree, x0, x1):
+	'''
+	Find all elements whose centroids lie within an axis-aligned box.
+	
+	Arguments:
+	tree -- spatial index (see "spatial_index")
+	x0 -- minimum box coordinates (x,y,z)
+	x1 -- maximum box coordinates (x,y,z)
+	
+	Returns:
+	i -- zero-based element indices (element ID - 1):  a sorted integer array
+	'''
+	x0,x1     = np.asarray(x0, dtype=float), np.asarray(x1, dtype=float)
+	i         = tree.query_ball_point(0.5*(x0+x1), 0.5*(x1-x0).max(), p=np.inf)
+	i         = np.array(sorted(i), dtype=int)
+	C         = tree.data[i]
+	return i[ np.all((C>=x0) & (C<=x1), axis=1) ]
+
+
+def roi_elementset(fnameFEB, name):
+	'''
+	Find all elements belonging to a named element set.
+	
+	Both <ElementSet> definitions and named <Elements> blocks (the "elset" or
+	"name" attribute) are searched.
+	
+	Arguments:
+	fnameFEB -- FEB file
+	name -- element set name
+	
+	Returns:
+	i -- zero-based element indices (element ID - 1):  a sorted integer array
+	'''
+	tree      = ElementTree()
+	tree.parse(fnameFEB)
+	root      = tree.getroot()
+	ids       = [int(elem.get('id'))   for elem in root.findall('Geometry/ElementSet[@name="%s"]/elem' %name)]
+	for elems in root.findall('Geometry/Elements'):
+		if name in (elems.get('elset'), elems.get('name')):
+			ids += [int(elem.get('id'))   for elem in elems.findall('elem')]
+	if len(ids)==0:
+		raise( ValueError('No element set named "%s" in:\n   %s' %(name,fnameFEB))  )
+	nElements = element_index(fnameFEB, root)['elementIDs'].size
+	i         = np.unique(ids) - 1
+	if (i[0] < 0) or (i[-1] >= nElements):
+		raise( ValueError('Element set "%s" references elements missing from the Geometry section of:\n   %s' %(name,fnameFEB))  )
+	return i
+
+
+def roi_sphere(tree, x, r):
+	'''
+	Find all elements whose centroids lie within a sphere.
+	
+	Arguments:
+	tree -- spatial index (see "spatial_index")
+	x -- sphere center (x,y,z)
+	r -- sphere radius
+	
+	Returns:
+	i -- zero-based element indices (element ID - 1):  a sorted integer array
+	'''
+	return np.array(sorted(tree.query_ball_point(x, r)), dtype=int)
+
+
+def roi_surface(fnameFEB, name):
+	'''
+	Find all elements with a face on a named surface.
+	
+	Arguments:
+	fnameFEB -- FEB file
+	name -- surface name
+	
+	Returns:
+	i -- zero-based element indices (element ID - 1):  a sorted integer array
+	'''
+	tree      = ElementTree()
+	tree.parse(fnameFEB)
+	root      = tree.getroot()
+	faces     = [[int(i) for i in face.text.split(',')]   for face in root.findall('Geometry/Surface[@name="%s"]/*' %name)]
+	if len(faces)==0:
+		raise( ValueError('No surface named "%s" in:\n   %s' %(name,fnameFEB))  )
+	index     = element_index(fnameFEB, root)
+	nodeIDs,indptr,indices = index['nodeIDs'], index['indptr'], index['indices']
+	def node2elem(node):
+		k     = np.searchsorted(nodeIDs, node)
+		if (k==nodeIDs.size) or (nodeIDs[k]!=node):
+			return set()
+		return set( indices[indptr[k]:indptr[k+1]].tolist() )
+	i         = set()
+	for face in faces:
+		i    |= set.intersection( *[node2elem(node)   for node in face] )
+	return np.array(sorted(i), dtype=int)
+
+
+def spatial_index(fnameFEB):
+	'''
+	Build a spatial index (KD-tree) of element centroids for region-of-interest queries.
+	
+	Arguments:
+	fnameFEB -- FEB file
+	
+	Returns:
+	tree -- a scipy.spatial.cKDTree object;  tree.data contains the element centroids
+	'''
+	from scipy.spatial import cKDTree   #SciPy is only required for spatial queries
+	return cKDTree( element_index(fnameFEB)['centroids'] )
 
 
 def tensor2effective(Y):
@@ -126,7 +379,8 @@ os.system('%s %s'%(path2febio, fnameTEMP))
 #(2) Parse log file:
 print('Parsing log file...')
 fnameLOG    = os.path.splitext(fnameTEMP)[0] + '.log'
-A           = parse_logfile( fnameLOG )
+elements    = None if (surfaceROI is None) else roi_surface(fnameFEB, surfaceROI)
+A           = parse_logfile( fnameLOG, elements )
 strain      = tensor2effective(A[:,:6])
 stress      = tensor2effective(A[:,6:])
 